@@ -0,0 +1,40 @@
+"""
+Semantic response cache for Online Shopping LLM agents
+"""
+
+import math
+import operator
+
+
+class SemanticCache:
+    """Caches agent responses keyed by the embedding of their input"""
+
+    def __init__(self, embeddings, threshold=0.92, max_entries=256):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entries = []
+
+    async def alookup(self, text):
+        """Return the closest cached response (or None) and the embedding of text"""
+        vector = self._normalize(await self.embeddings.aembed_query(text))
+        best_score, best_response = 0.0, None
+        for cached_vector, response in self.entries:
+            # Vectors are unit length, so the dot product is the cosine similarity
+            score = sum(map(operator.mul, vector, cached_vector))
+            if score > best_score:
+                best_score, best_response = score, response
+        if best_score >= self.threshold:
+            return best_response, vector
+        return None, vector
+
+    def store(self, vector, response):
+        """Cache a response under its input embedding, evicting the oldest entry"""
+        if len(self.entries) >= self.max_entries:
+            self.entries.pop(0)
+        self.entries.append((vector, response))
+
+    @staticmethod
+    def _normalize(vector):
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
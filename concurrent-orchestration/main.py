@@ -1,158 +1,345 @@
 import sys
+import re
 import warnings
 import asyncio
-import uuid
+import functools
+import secrets
+import threading
+import time
+import weakref
 from datetime import datetime
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import SystemMessage, AIMessage
-from langsmith import traceable
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langsmith import traceable, tracing_context
 from dotenv import load_dotenv
 import os
+from cache import SemanticCache
 from prompts import (
     SHOPPING_AGENT_PROMPT,
     PRODUCT_CATALOG_AGENT_PROMPT,
     CUSTOMER_SERVICE_AGENT_PROMPT,
-    PAYMENT_AGENT_PROMPT
+    PAYMENT_AGENT_PROMPT,
+    PROMPT_HASHES
 )
 
 # Suppress LangChain deprecation warnings
 warnings.filterwarnings("ignore", message=".*LangChain.*")
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-from langchain.memory import ConversationBufferMemory
+from memory import SummaryBufferMemory
 
 load_dotenv()
 
+# Read once at import; the client factories below reuse it
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# Dialogue/triage agents run on the smaller tier; catalog and payment keep the main model
+# (the lite tier of the main model's generation). Override with GEMINI_MAIN_MODEL/GEMINI_SMALL_MODEL.
+MAIN_MODEL = os.getenv("GEMINI_MAIN_MODEL", "gemini-2.0-flash-exp")
+SMALL_MODEL = os.getenv("GEMINI_SMALL_MODEL", "gemini-2.0-flash-lite")
+
+# Upper bound on in-flight Gemini calls across all sessions, sized to the quota tier,
+# so wider fan-outs and more customers don't trip rate limits
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("GEMINI_MAX_CONCURRENCY", "20"))
+
+SEP = "=" * 60
+
+# The shopping prompt requires this marker to open the reply, so a prefix check suffices
+READY_TO_PURCHASE = "READY_TO_PURCHASE:"
+
+# Catalog findings that still need the customer service agent
+NEEDS_CUSTOMER_SERVICE_RE = re.compile(r"\b(out[ _]of[ _]stock|returns?|warranty)\b", re.IGNORECASE)
+
+# Static system prompt first, history after it, so Gemini's implicit prefix cache can match
+SHOPPING_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system", SHOPPING_AGENT_PROMPT),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}")
+])
+
+
+def _agent_prompt(system_prompt, human_template):
+    """Build a downstream agent prompt: static system prompt, then the templated input"""
+    return ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        ("human", human_template)
+    ])
+
+
+# The catalog agent is prefetched before the shopping summary exists, so it gets the
+# same context as the shopping agent: a bare "yes" or "the second one" needs the history
+CATALOG_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system", PRODUCT_CATALOG_AGENT_PROMPT),
+    MessagesPlaceholder("chat_history"),
+    ("human", "User request: {input}")
+])
+CUSTOMER_SERVICE_PROMPT_TEMPLATE = _agent_prompt(CUSTOMER_SERVICE_AGENT_PROMPT, "Shopping Agent output: {input}")
+PAYMENT_PROMPT_TEMPLATE = _agent_prompt(
+    PAYMENT_AGENT_PROMPT,
+    "Catalog Information:\n{catalog}\n\nCustomer Service Information:\n{service}\n\nOriginal Request: {shopping}"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm(model):
+    """Gemini client for a model, shared by every orchestrator session"""
+    return ChatGoogleGenerativeAI(
+        model=model,
+        api_key=GEMINI_API_KEY,
+        temperature=0.4
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_embeddings():
+    """Embedding client shared by every semantic cache"""
+    return GoogleGenerativeAIEmbeddings(
+        model="models/text-embedding-004",
+        google_api_key=GEMINI_API_KEY,
+        task_type="semantic_similarity"
+    )
+
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_semaphore():
+    """Semaphore bounding Gemini calls from every session on the running event loop"""
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+    return _semaphores[loop]
+
+
+_sync_loop = None
+
+
+def run_sync(coro):
+    """Run a coroutine on the one private event loop behind every synchronous entry point.
+    The Gemini clients are shared process-wide and their async gRPC channels are bound to
+    the first loop that uses them, so all sync callers must drive the same loop."""
+    global _sync_loop
+    if _sync_loop is None:
+        _sync_loop = asyncio.new_event_loop()
+    return _sync_loop.run_until_complete(coro)
+
+
+async def ainput(prompt=""):
+    """input() on a daemon thread feeding an asyncio queue. Unlike the default
+    executor, a read still pending at Ctrl-C doesn't hold up interpreter exit."""
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue(maxsize=1)
+    
+    def read():
+        try:
+            line = input(prompt)
+        except EOFError as e:
+            line = e
+        try:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        except RuntimeError:
+            pass  # Event loop already closed
+    
+    threading.Thread(target=read, daemon=True).start()
+    line = await lines.get()
+    if isinstance(line, EOFError):
+        raise line
+    return line
+
+
 class MultiAgentConcurrentOrchestrator:
     """Handles concurrent orchestration of shopping agents"""
     
     def __init__(self):
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",
-            api_key=os.getenv("GEMINI_API_KEY"),
-            temperature=0.4
+        self.llm_main = get_llm(MAIN_MODEL)
+        self.llm_small = get_llm(SMALL_MODEL)
+        # Summarize older turns so the shopping prompt stays bounded; the buffer
+        # is sized with a local token estimate rather than Gemini's count_tokens API
+        self.memory = SummaryBufferMemory(
+            llm=self.llm_small,
+            memory_key="chat_history",
+            return_messages=True,
+            max_token_limit=512
         )
-        self.memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+        
+        # Only the customer service agent is cached, per session. The shopping agent depends on
+        # memory; catalog and payment carry the prices and order IDs of one specific order, and
+        # near-duplicate requests (16GB vs 32GB) would replay the wrong one. Built on first
+        # use, so the embedding client binds to the running event loop.
+        self.customer_service_cache = None
+        
+        # Speculative catalog prefetch counters, to judge whether the extra call pays off
+        self.prefetch_attempts = 0
+        self.prefetch_hits = 0
+    
+    @staticmethod
+    def _extract(response):
+        """Text of an LLM response; chat models return an AIMessage with .content"""
+        content = getattr(response, "content", None)
+        return str(response) if content is None else content
+    
+    async def _ainvoke(self, llm, messages, cache=None, stream=False):
+        """Invoke the LLM, serving near-duplicate inputs from the agent's cache.
+        With stream=True the response is printed as it is generated."""
+        if cache is not None:
+            payload = "\n".join(str(message.content) for message in messages[1:])
+            cached, vector = await cache.alookup(payload)
+            if cached is not None:
+                if stream:
+                    print(cached, end="", flush=True)
+                return cached
+        
+        async with get_semaphore():
+            if stream:
+                chunks = []
+                async for chunk in llm.astream(messages):
+                    print(chunk.content, end="", flush=True)
+                    chunks.append(chunk.content)
+                result = "".join(chunks)
+            else:
+                response = await llm.ainvoke(messages)
+                result = self._extract(response)
+        if cache is not None:
+            cache.store(vector, result)
+        return result
     
     @traceable(run_type="llm", name="Shopping Agent")
-    def call_shopping_agent(self, user_input, chat_history, config=None):
+    async def call_shopping_agent(self, user_input, chat_history, stream=False):
         """Call shopping agent with user input"""
-        messages = [
-            SystemMessage(content=f"{SHOPPING_AGENT_PROMPT}\n\nConversation History: {chat_history}"),
-            AIMessage(content=f"User request: {user_input}")
-        ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+        messages = SHOPPING_PROMPT_TEMPLATE.format_messages(chat_history=chat_history, input=user_input)
+        return await self._ainvoke(self.llm_small, messages, stream=stream)
     
     @traceable(run_type="llm", name="Product Catalog Agent")
-    def call_catalog_agent(self, shopping_output, config=None):
-        """Call catalog agent with shopping agent output"""
-        messages = [
-            SystemMessage(content=PRODUCT_CATALOG_AGENT_PROMPT),
-            AIMessage(content=f"Shopping Agent output: {shopping_output}")
-        ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+    async def call_catalog_agent(self, user_input, chat_history):
+        """Call catalog agent with the user request and the conversation so far"""
+        messages = CATALOG_PROMPT_TEMPLATE.format_messages(chat_history=chat_history, input=user_input)
+        return await self._ainvoke(self.llm_main, messages)
     
     @traceable(run_type="llm", name="Customer Service Agent")
-    def call_customer_service_agent(self, shopping_output, config=None):
+    async def call_customer_service_agent(self, shopping_output):
         """Call customer service agent with shopping agent output"""
-        messages = [
-            SystemMessage(content=CUSTOMER_SERVICE_AGENT_PROMPT),
-            AIMessage(content=f"Shopping Agent output: {shopping_output}")
-        ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+        messages = CUSTOMER_SERVICE_PROMPT_TEMPLATE.format_messages(input=shopping_output)
+        if self.customer_service_cache is None:
+            self.customer_service_cache = SemanticCache(get_embeddings())
+        return await self._ainvoke(self.llm_small, messages, cache=self.customer_service_cache)
     
     @traceable(run_type="llm", name="Payment Agent")
-    def call_payment_agent(self, catalog_output, service_output, shopping_output, config=None):
+    async def call_payment_agent(self, catalog_output, service_output, shopping_output, stream=False):
         """Call payment agent with catalog and service agent outputs"""
-        messages = [
-            SystemMessage(content=PAYMENT_AGENT_PROMPT),
-            AIMessage(content=f"Catalog Agent output: {catalog_output}\n\nCustomer Service Agent output: {service_output}")
-        ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+        messages = PAYMENT_PROMPT_TEMPLATE.format_messages(
+            catalog=catalog_output, service=service_output, shopping=shopping_output
+        )
+        return await self._ainvoke(self.llm_main, messages, stream=stream)
     
     async def orchestrate_async(self, user_input):
         """Async orchestration logic with concurrent agent execution"""
+        # Snapshot the (summary-bounded) history once per turn and reuse it below
+        chat_history = (await self.memory.aload_memory_variables({})).get("chat_history", [])
+        
         # Generate unique transaction ID
-        transaction_id = str(uuid.uuid4())
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        transaction_id = secrets.token_hex(16)
+        timestamp_ns = time.time_ns()
+        
+        print(f"[Transaction ID: {transaction_id}]")
+        print(f"[Timestamp: {datetime.fromtimestamp(timestamp_ns / 1e9):%Y-%m-%d %H:%M:%S}]\n")
         
-        # Create config with transaction metadata
-        run_config = {
-            "tags": [f"transaction:{transaction_id}"],
-            "metadata": {
+        # Agent runs pick up the tags and transaction metadata from the tracing context;
+        # the per-transaction ID goes in metadata only, keeping the tag list fixed
+        with tracing_context(
+            tags=["concurrent-orchestration"],
+            metadata={
                 "transaction_id": transaction_id,
-                "timestamp": timestamp,
+                "timestamp_ns": timestamp_ns,
                 "user_input": user_input[:100]  # First 100 chars
             }
-        }
+        ):
+            final_result = await self._run_agents(user_input, chat_history)
         
-        print(f"[Transaction ID: {transaction_id}]")
-        print(f"[Timestamp: {timestamp}]\n")
-        
-        # Step 1: Shopping agent
+        # Save to memory
+        await self.memory.asave_context({"input": user_input}, {"output": final_result})
+        return final_result
+    
+    async def _run_agents(self, user_input, chat_history):
+        """Run the agents for one turn and return the reply to save in memory"""
+        # Step 1: Shopping agent, with the catalog lookup prefetched speculatively
         print("[1/4] Shopping Agent...")
-        chat_history = self.memory.load_memory_variables({}).get("chat_history", [])
-        
-        shopping_result = self.call_shopping_agent(user_input, chat_history, config=run_config)
-        print(f"      {shopping_result}\n")
+        catalog_task = asyncio.create_task(self.call_catalog_agent(user_input, chat_history))
+        self.prefetch_attempts += 1
+        print("      ", end="", flush=True)
+        try:
+            shopping_result = await self.call_shopping_agent(user_input, chat_history, stream=True)
+        except BaseException:
+            catalog_task.cancel()
+            raise
+        print("\n")
         
         # Step 2 & 3: Check if ready to purchase
-        if "READY_TO_PURCHASE:" in shopping_result:
+        if shopping_result.lstrip().startswith(READY_TO_PURCHASE):
             print("[2/4] Catalog Agent (running concurrently)...")
             print("[3/4] Customer Service Agent (running concurrently)...")
             
-            # Run catalog and customer service agents concurrently
-            catalog_task = asyncio.to_thread(
-                self.call_catalog_agent, shopping_result, run_config
-            )
-            service_task = asyncio.to_thread(
-                self.call_customer_service_agent, shopping_result, run_config
-            )
-            
-            catalog_result, service_result = await asyncio.gather(catalog_task, service_task)
-            print("      Complete\n")
+            # Customer service runs alongside the prefetched catalog, but is only
+            # kept when the catalog raises stock, return or warranty questions
+            self.prefetch_hits += 1
+            service_task = asyncio.create_task(self.call_customer_service_agent(shopping_result))
+            try:
+                catalog_result = await catalog_task
+            except BaseException:
+                service_task.cancel()
+                raise
+            if NEEDS_CUSTOMER_SERVICE_RE.search(catalog_result):
+                service_result = await service_task
+                print("      Complete\n")
+            else:
+                service_task.cancel()
+                service_result = "No customer service follow-up required."
+                print("      Complete (customer service not needed)\n")
             
             # Step 4: Payment agent with combined results
-            print("[4/4] Payment Agent...")
+            print("[4/4] Payment Agent...\n")
             
-            payment_result = self.call_payment_agent(catalog_result, service_result, shopping_result, config=run_config)
-            print("      Complete\n")
-            
-            print("=" * 60)
-            print("ORDER SUMMARY")
-            print("=" * 60)
-            print(payment_result)
-            print("=" * 60)
-            final_result = payment_result
-        else:
-            final_result = shopping_result
+            sys.stdout.write(f"{SEP}\nORDER SUMMARY\n{SEP}\n")
+            payment_result = await self.call_payment_agent(
+                catalog_result, service_result, shopping_result, stream=True
+            )
+            sys.stdout.write(f"\n{SEP}\n")
+            return payment_result
         
-        # Save to memory
-        self.memory.save_context({"input": user_input}, {"output": final_result})
-        return final_result
+        catalog_task.cancel()
+        return shopping_result
     
     def orchestrate(self, user_input):
-        """Synchronous wrapper for async orchestration"""
-        return asyncio.run(self.orchestrate_async(user_input))
+        """Synchronous wrapper for async orchestration, run on the shared private event loop"""
+        return run_sync(self.orchestrate_async(user_input))
     
     def run(self):
-        """Main conversation loop"""
+        """Main conversation loop, on the same event loop as orchestrate()"""
+        try:
+            run_sync(self._run_async())
+        finally:
+            print(self.prefetch_report())
+    
+    def prefetch_report(self):
+        """How often the speculative catalog call was used, to judge whether it pays off"""
+        rate = self.prefetch_hits / self.prefetch_attempts if self.prefetch_attempts else 0.0
+        return f"[Catalog prefetch: {self.prefetch_hits}/{self.prefetch_attempts} used ({rate:.0%})]"
+    
+    async def _run_async(self):
+        """Conversation loop; input is read off the event loop so it stays free"""
+        revisions = ", ".join(f"{name}={digest[:12]}" for name, digest in PROMPT_HASHES.items())
+        print(f"[Prompt revisions: {revisions}]\n")
         print("Shopping Agent: Hello! How can I help you today?\n")
         
         while True:
             try:
-                user_input = input("> ").strip()
+                user_input = (await ainput("> ")).strip()
                 if user_input.lower() in ['quit', 'exit', 'q']:
                     print("\nThank you for shopping with us!")
                     break
                 if user_input:
-                    self.orchestrate(user_input)
+                    await self.orchestrate_async(user_input)
                     print()
-            except KeyboardInterrupt:
+            except (KeyboardInterrupt, EOFError):
                 print("\n\nGoodbye!")
                 break
             except Exception as e:
@@ -2,6 +2,8 @@
 System prompts for Online Shopping LLM agents
 """
 
+import hashlib
+
 SHOPPING_AGENT_PROMPT = """You are a smart Shopping Assistant with conversation memory. Make intelligent decisions based on conversation history.
 
 Guidelines:
@@ -21,6 +23,7 @@ Decision Logic - When to Proceed to Purchase:
 
 IMPORTANT: When you have enough information to proceed with a purchase (product type and any preference), 
 you MUST start your response with the marker: READY_TO_PURCHASE:
+The marker must be the very first text of your reply, with nothing (not even formatting) before it.
 Then provide a brief summary of what the customer wants.
 
 Example: "READY_TO_PURCHASE: Customer wants a gaming laptop with high performance graphics."
@@ -68,3 +71,15 @@ Create a final order summary as a JSON object with:
     "order_confirmation": "confirmation message",
     "order_id": "generated order ID"
 }}"""
+
+# Stable digests of the static prompts; identical prefixes are what provider-side
+# prompt caches match on, so a changed digest explains a drop in cache hits
+PROMPT_HASHES = {
+    name: hashlib.sha256(prompt.encode()).hexdigest()
+    for name, prompt in (
+        ("shopping", SHOPPING_AGENT_PROMPT),
+        ("catalog", PRODUCT_CATALOG_AGENT_PROMPT),
+        ("customer_service", CUSTOMER_SERVICE_AGENT_PROMPT),
+        ("payment", PAYMENT_AGENT_PROMPT),
+    )
+}
@@ -1,128 +1,309 @@
 import sys
+import re
 import warnings
-import uuid
+import asyncio
+import functools
+import json
+import secrets
+import threading
+import time
+import weakref
 from datetime import datetime
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import SystemMessage, AIMessage
+from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.rate_limiters import InMemoryRateLimiter
 from langsmith import traceable
 from dotenv import load_dotenv
 import os
-from prompts import SHOPPING_AGENT_PROMPT, PRODUCT_CATALOG_AGENT_PROMPT, PAYMENT_AGENT_PROMPT
+from schemas import CatalogPaymentResponse
+from prompts import (
+    SHOPPING_AGENT_PROMPT,
+    COMBINED_CATALOG_PAYMENT_PROMPT,
+    PROMPT_HASHES
+)
 
 # Suppress LangChain deprecation warnings
 warnings.filterwarnings("ignore", message=".*LangChain.*")
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-from langchain.memory import ConversationBufferMemory
+from memory import SummaryBufferMemory
 
 load_dotenv()
 
+# Read once at import; the client factories below reuse it
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# Dialogue agent runs on the smaller tier; catalog and payment keep the main model
+# (the lite tier of the main model's generation). Override with GEMINI_MAIN_MODEL/GEMINI_SMALL_MODEL.
+MAIN_MODEL = os.getenv("GEMINI_MAIN_MODEL", "gemini-2.0-flash-exp")
+SMALL_MODEL = os.getenv("GEMINI_SMALL_MODEL", "gemini-2.0-flash-lite")
+
+# Upper bound on in-flight Gemini calls across all orchestrators, sized to the quota tier,
+# and an optional requests-per-second cap for strict per-minute quotas
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("GEMINI_MAX_CONCURRENCY", "20"))
+MAX_REQUESTS_PER_SECOND = float(os.getenv("GEMINI_MAX_RPS", "0"))
+
+SEP = "=" * 60
+
+# The shopping prompt requires this marker to open the reply, so a prefix check suffices
+READY_TO_PURCHASE = "READY_TO_PURCHASE:"
+
+# Explicit purchase confirmations ("yes, buy it", "checkout"). Used with fullmatch, so the
+# whole input must be the confirmation: "buy it if it is under $500" or "check out the
+# laptops you mentioned" go to the shopping agent as usual
+PURCHASE_INTENT_RE = re.compile(
+    r"\s*(?:(?:yes|ok(?:ay)?|sure)[,.!]?\s*)?(?:please\s+)?"
+    r"(?:checkout|buy (?:it|this|that|now)|place (?:the |my )?order"
+    r"|purchase (?:it|this|that|now)|proceed to (?:checkout|purchase))"
+    r"(?: now)?(?:,?\s*please)?\s*[.!]*\s*",
+    re.IGNORECASE
+)
+
+# Line the shopping agent ends with when it proposes one specific product for confirmation
+PROPOSED_PRODUCT_RE = re.compile(r"^PROPOSED_PRODUCT:\s*(.+?)\s*$", re.MULTILINE)
+
+# System messages are built once and reused by every call
+SHOPPING_SYSTEM_MESSAGE = SystemMessage(content=SHOPPING_AGENT_PROMPT)
+CATALOG_PAYMENT_SYSTEM_MESSAGE = SystemMessage(content=COMBINED_CATALOG_PAYMENT_PROMPT)
+
+# Static system prompt first, history after it, so Gemini's implicit prefix cache can match
+SHOPPING_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    SHOPPING_SYSTEM_MESSAGE,
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}")
+])
+
+
+def route_decision(shopping_result):
+    """Route to the catalog agent when the shopping agent opens with the purchase marker"""
+    return "catalog" if shopping_result.lstrip().startswith(READY_TO_PURCHASE) else "chat"
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm(model):
+    """Gemini client for a model, shared by every orchestrator instance"""
+    return ChatGoogleGenerativeAI(
+        model=model,
+        api_key=GEMINI_API_KEY,
+        temperature=0.4,
+        rate_limiter=(
+            InMemoryRateLimiter(requests_per_second=MAX_REQUESTS_PER_SECOND)
+            if MAX_REQUESTS_PER_SECOND > 0 else None
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_json_llm(model, schema):
+    """Gemini client constrained to JSON output matching a Pydantic schema"""
+    return get_llm(model).bind(
+        response_mime_type="application/json",
+        response_schema=schema.model_json_schema()
+    )
+
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_semaphore():
+    """Semaphore bounding Gemini calls from every orchestrator on the running event loop"""
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+    return _semaphores[loop]
+
+
+_sync_loop = None
+
+
+def run_sync(coro):
+    """Run a coroutine on the one private event loop behind every synchronous entry point.
+    The Gemini clients are shared process-wide and their async gRPC channels are bound to
+    the first loop that uses them, so all sync callers must drive the same loop."""
+    global _sync_loop
+    if _sync_loop is None:
+        _sync_loop = asyncio.new_event_loop()
+    return _sync_loop.run_until_complete(coro)
+
+
+async def ainput(prompt=""):
+    """input() on a daemon thread feeding an asyncio queue. Unlike the default
+    executor, a read still pending at Ctrl-C doesn't hold up interpreter exit."""
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue(maxsize=1)
+    
+    def read():
+        try:
+            line = input(prompt)
+        except EOFError as e:
+            line = e
+        try:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        except RuntimeError:
+            pass  # Event loop already closed
+    
+    threading.Thread(target=read, daemon=True).start()
+    line = await lines.get()
+    if isinstance(line, EOFError):
+        raise line
+    return line
+
+
 class MultiAgentSequentialOrchestrator:
     """Handles sequential orchestration of shopping agents"""
     
     def __init__(self):
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",
-            api_key=os.getenv("GEMINI_API_KEY"),
-            temperature=0.4
+        self.llm_main = get_llm(MAIN_MODEL)
+        self.llm_small = get_llm(SMALL_MODEL)
+        # The combined catalog and payment reply is JSON enforced by Gemini's response schema
+        self.llm_catalog_payment = get_json_llm(MAIN_MODEL, CatalogPaymentResponse)
+        # Summarize older turns so the shopping prompt stays bounded; the buffer
+        # is sized with a local token estimate rather than Gemini's count_tokens API
+        self.memory = SummaryBufferMemory(
+            llm=self.llm_small,
+            memory_key="chat_history",
+            return_messages=True,
+            max_token_limit=512
         )
-        self.memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+        # Product the shopping agent last proposed, so a bare "buy it" can go straight to checkout
+        self._last_selection = None
+    
+    @staticmethod
+    def _extract(response):
+        """Text of an LLM response; chat models return an AIMessage with .content"""
+        content = getattr(response, "content", None)
+        return str(response) if content is None else content
+    
+    async def _ainvoke(self, llm, messages, config=None, stream=False):
+        """Invoke the LLM; with stream=True the response is printed as it is generated"""
+        async with get_semaphore():
+            if stream:
+                chunks = []
+                async for chunk in llm.astream(messages, config=config):
+                    print(chunk.content, end="", flush=True)
+                    chunks.append(chunk.content)
+                result = "".join(chunks)
+            else:
+                response = await llm.ainvoke(messages, config=config)
+                result = self._extract(response)
+        return result
     
     @traceable(run_type="llm", name="Shopping Agent")
-    def call_shopping_agent(self, user_input, chat_history, config=None):
+    async def acall_shopping_agent(self, user_input, chat_history, config=None, stream=False):
         """Call shopping agent with user input"""
-        messages = [
-            SystemMessage(content=f"{SHOPPING_AGENT_PROMPT}\n\nConversation History: {chat_history}"),
-            AIMessage(content=f"User request: {user_input}")
-        ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+        messages = SHOPPING_PROMPT_TEMPLATE.format_messages(chat_history=chat_history, input=user_input)
+        return await self._ainvoke(self.llm_small, messages, config=config, stream=stream)
     
-    @traceable(run_type="llm", name="Product Catalog Agent")
-    def call_catalog_agent(self, shopping_output, config=None):
-        """Call catalog agent with shopping agent output"""
-        messages = [
-            SystemMessage(content=PRODUCT_CATALOG_AGENT_PROMPT),
-            AIMessage(content=f"Shopping Agent output: {shopping_output}")
+    @classmethod
+    @traceable(run_type="llm", name="Shopping Agent Batch")
+    async def acall_shopping_agent_batch(cls, items, config=None):
+        """Call shopping agent for several (user_input, chat_history) turns in one batch.
+        Only the shared small-model client is used, so turns may come from any session;
+        pass the caller's run config so the batch keeps its transaction tags and metadata."""
+        all_messages = [
+            SHOPPING_PROMPT_TEMPLATE.format_messages(chat_history=chat_history, input=user_input)
+            for user_input, chat_history in items
         ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+        llm = get_llm(SMALL_MODEL)
+        semaphore = get_semaphore()
+        
+        # One permit per turn, so a batch counts against GEMINI_MAX_CONCURRENCY like separate
+        # calls would; a chat model's abatch is concurrent ainvokes under the hood anyway
+        async def invoke(messages):
+            async with semaphore:
+                return await llm.ainvoke(messages, config=config)
+        
+        responses = await asyncio.gather(*(invoke(messages) for messages in all_messages))
+        return [cls._extract(response) for response in responses]
     
-    @traceable(run_type="llm", name="Payment Agent")
-    def call_payment_agent(self, catalog_output, config=None):
-        """Call payment agent with catalog agent output"""
+    @traceable(run_type="llm", name="Catalog and Payment Agent")
+    async def acall_catalog_and_payment(self, shopping_output, config=None):
+        """Call the combined catalog and payment agent with shopping agent output.
+        Returns the parsed {"catalog": ..., "payment": ...} reply."""
         messages = [
-            SystemMessage(content=PAYMENT_AGENT_PROMPT),
-            AIMessage(content=f"Catalog Agent output: {catalog_output}")
+            CATALOG_PAYMENT_SYSTEM_MESSAGE,
+            HumanMessage(content=f"Shopping Agent output: {shopping_output}")
         ]
-        response = self.llm.invoke(messages, config=config)
-        return response.content if hasattr(response, 'content') else str(response)
+        result = await self._ainvoke(self.llm_catalog_payment, messages, config=config)
+        return json.loads(result)
     
-    def orchestrate(self, user_input):
-        """Main orchestration logic"""
+    async def aorchestrate(self, user_input, stream=False):
+        """Main orchestration logic; stream=True prints agent replies token by token"""
         # Generate unique transaction ID
-        transaction_id = str(uuid.uuid4())
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        transaction_id = secrets.token_hex(16)
+        timestamp_ns = time.time_ns()
         
-        # Create config with transaction metadata
+        # Create config with transaction metadata; the per-transaction ID stays out of
+        # the tags so every span carries the same short, fixed tag list
         run_config = {
-            "tags": [f"transaction:{transaction_id}"],
+            "tags": ["sequential-orchestration"],
             "metadata": {
                 "transaction_id": transaction_id,
-                "timestamp": timestamp,
+                "timestamp_ns": timestamp_ns,
                 "user_input": user_input[:100]  # First 100 chars
             }
         }
         
         print(f"[Transaction ID: {transaction_id}]")
-        print(f"[Timestamp: {timestamp}]\n")
-        
-        # Step 1: Shopping agent
-        print("[1/3] Shopping Agent...")
-        chat_history = self.memory.load_memory_variables({}).get("chat_history", [])
+        print(f"[Timestamp: {datetime.fromtimestamp(timestamp_ns / 1e9):%Y-%m-%d %H:%M:%S}]\n")
         
-        shopping_result = self.call_shopping_agent(user_input, chat_history, config=run_config)
-        print(f"      {shopping_result}\n")
+        # Step 1: Shopping agent, skipped when the user confirms its last proposal
+        print("[1/2] Shopping Agent...")
+        if self._last_selection and PURCHASE_INTENT_RE.fullmatch(user_input):
+            shopping_result = f"{READY_TO_PURCHASE} Customer confirmed ({user_input}) - {self._last_selection}"
+            print(f"      {shopping_result}\n")
+        else:
+            chat_history = (await self.memory.aload_memory_variables({})).get("chat_history", [])
+            print("      ", end="", flush=True)
+            shopping_result = await self.acall_shopping_agent(user_input, chat_history, config=run_config, stream=stream)
+            print("\n" if stream else f"{shopping_result}\n")
         
         # Step 2: Check if ready to purchase
-        if "READY_TO_PURCHASE:" in shopping_result:
-            print("[2/3] Product Catalog Agent...")
-            
-            catalog_result = self.call_catalog_agent(shopping_result, config=run_config)
-            print("      Complete")
-            
-            print("[3/3] Payment Agent...")
+        if route_decision(shopping_result) == "catalog":
+            print("[2/2] Catalog and Payment Agent...\n")
             
-            payment_result = self.call_payment_agent(catalog_result, config=run_config)
-            print("      Complete\n")
+            # One round-trip returns both the catalog details and the order summary
+            catalog_payment = await self.acall_catalog_and_payment(shopping_result, config=run_config)
+            payment_result = json.dumps(catalog_payment["payment"], indent=2)
             
-            print("=" * 60)
-            print("ORDER SUMMARY")
-            print("=" * 60)
-            print(payment_result)
-            print("=" * 60)
+            sys.stdout.write(f"{SEP}\nORDER SUMMARY\n{SEP}\n{payment_result}\n{SEP}\n")
             final_result = payment_result
+            self._last_selection = None
         else:
             final_result = shopping_result
+            # Greetings and clarifying questions propose nothing, so they clear the selection
+            proposal = PROPOSED_PRODUCT_RE.search(shopping_result)
+            self._last_selection = proposal.group(1) if proposal else None
         
         # Save to memory
-        self.memory.save_context({"input": user_input}, {"output": final_result})
+        await self.memory.asave_context({"input": user_input}, {"output": final_result})
         return final_result
     
+    def orchestrate(self, user_input, stream=False):
+        """Synchronous wrapper for aorchestrate, run on the shared private event loop"""
+        return run_sync(self.aorchestrate(user_input, stream=stream))
+    
     def run(self):
-        """Main conversation loop"""
+        """Main conversation loop, on the same event loop as orchestrate()"""
+        run_sync(self._run_async())
+    
+    async def _run_async(self):
+        """Conversation loop; input is read off the event loop so it stays free"""
+        revisions = ", ".join(f"{name}={digest[:12]}" for name, digest in PROMPT_HASHES.items())
+        print(f"[Prompt revisions: {revisions}]\n")
         print("Shopping Agent: Hello! How can I help you today?\n")
         
         while True:
             try:
-                user_input = input("> ").strip()
+                user_input = (await ainput("> ")).strip()
                 if user_input.lower() in ['quit', 'exit', 'q']:
                     print("\nThank you for shopping with us!")
                     break
                 if user_input:
-                    self.orchestrate(user_input)
+                    await self.aorchestrate(user_input, stream=True)
                     print()
-            except KeyboardInterrupt:
+            except (KeyboardInterrupt, EOFError):
                 print("\n\nGoodbye!")
                 break
             except Exception as e:
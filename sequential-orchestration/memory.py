@@ -0,0 +1,46 @@
+"""
+Conversation memory for Online Shopping LLM agents
+"""
+
+from langchain_core.messages import get_buffer_string
+from langchain.memory import ConversationSummaryBufferMemory
+
+# Rough characters-per-token ratio for English text, close enough to size the buffer
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(messages):
+    """Local token estimate for a list of messages, with no model round-trip"""
+    return len(get_buffer_string(messages)) // CHARS_PER_TOKEN
+
+
+class SummaryBufferMemory(ConversationSummaryBufferMemory):
+    """ConversationSummaryBufferMemory that sizes its buffer locally.
+
+    The base class counts tokens with llm.get_num_tokens_from_messages, which on
+    Gemini is a blocking count_tokens API call, repeated for every pruned message.
+    Only the summarization itself still goes to the model."""
+
+    def _pop_overflow(self):
+        """Remove and return the oldest messages until the buffer fits max_token_limit"""
+        buffer = self.chat_memory.messages
+        pruned_memory = []
+        while buffer and estimate_tokens(buffer) > self.max_token_limit:
+            pruned_memory.append(buffer.pop(0))
+        return pruned_memory
+
+    def prune(self):
+        """Prune buffer if it exceeds max token limit"""
+        pruned_memory = self._pop_overflow()
+        if pruned_memory:
+            self.moving_summary_buffer = self.predict_new_summary(
+                pruned_memory, self.moving_summary_buffer
+            )
+
+    async def aprune(self):
+        """Asynchronously prune buffer if it exceeds max token limit"""
+        pruned_memory = self._pop_overflow()
+        if pruned_memory:
+            self.moving_summary_buffer = await self.apredict_new_summary(
+                pruned_memory, self.moving_summary_buffer
+            )
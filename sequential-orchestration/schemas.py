@@ -0,0 +1,38 @@
+"""
+Response schemas for the JSON-producing Online Shopping LLM agents
+"""
+
+from typing import List
+from pydantic import BaseModel, Field
+
+
+class Product(BaseModel):
+    """A product offered by the catalog agent"""
+    name: str
+    price: str
+    description: str = Field(description="Brief description")
+    features: List[str] = Field(description="Key features")
+    availability: str = Field(description="In stock or out of stock")
+
+
+class CatalogResponse(BaseModel):
+    """Catalog agent output"""
+    products: List[Product]
+    total_items: int
+    catalog_summary: str = Field(description="Brief summary of the product selection")
+
+
+class PaymentResponse(BaseModel):
+    """Payment agent output: the final order summary"""
+    order_summary: str = Field(description="Complete order description")
+    total_amount: str = Field(description="Calculated total")
+    payment_options: List[str] = Field(description="Available payment methods")
+    estimated_delivery: str = Field(description="Delivery timeframe")
+    order_confirmation: str = Field(description="Confirmation message")
+    order_id: str = Field(description="Generated order ID")
+
+
+class CatalogPaymentResponse(BaseModel):
+    """Combined catalog and payment agent output"""
+    catalog: CatalogResponse
+    payment: PaymentResponse
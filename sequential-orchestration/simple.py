@@ -1,3 +1,4 @@
+import asyncio
 from langchain.agents import AgentExecutor, create_react_agent
 from langchain_core.tools import tool
 from langchain_core.prompts import PromptTemplate
@@ -58,12 +59,22 @@ agent_executor = AgentExecutor(
     handle_parsing_errors=True
 )
 
+
+async def main():
+    """Answer every question concurrently with the shared agent executor"""
+    questions = [
+        "What is the weather in San Francisco?",
+    ]
+    results = await asyncio.gather(
+        *(agent_executor.ainvoke({"input": question}) for question in questions)
+    )
+    for result in results:
+        print("\n" + "="*60)
+        print("RESULT:")
+        print("="*60)
+        print(result["output"])
+
+
 # Run the agent
 if __name__ == "__main__":
-    result = agent_executor.invoke(
-        {"input": "What is the weather in San Francisco?"}
-    )
-    print("\n" + "="*60)
-    print("RESULT:")
-    print("="*60)
-    print(result["output"])
+    asyncio.run(main())